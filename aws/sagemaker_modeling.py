@@ -1,12 +1,18 @@
-import argparse
 import joblib
 import os
-import json
-from io import StringIO
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
 
 if __name__ == '__main__':
+    # The training dependencies are only imported here, so loading this script in the inference container
+    # (which only calls model_fn) doesn't pay for them at startup
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    from sklearn.experimental import enable_hist_gradient_boosting # required by the 0.23 SKLearn container, a no-op on scikit-learn >= 1.0
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from threadpoolctl import threadpool_limits
+    
     parser = argparse.ArgumentParser()
     
     # Sagemaker specific arguments. Defaults are set in the environment variables.
@@ -17,54 +23,84 @@ if __name__ == '__main__':
     # hyperparameters sent by the client are passed as command-line arguments to the script
     parser.add_argument("--max-depth", type=int, default=2)
     parser.add_argument("--min-samples-leaf", type=int, default=7)
-    parser.add_argument("--min-samples-split", type=int, default=2)
+    parser.add_argument("--min-samples-split", type=int, default=2) # not used by HistGradientBoostingRegressor, kept so existing jobs still launch
     parser.add_argument("--n-estimators", type=int, default=50)
+    parser.add_argument("--n-jobs", type=int, default=-1) # joblib convention: -1 trains on every core, -2 on all but one, ...
     
     args = parser.parse_args()
+    if args.n_jobs == 0:
+        parser.error("--n-jobs must not be 0")
     
     # Take the set of files and read them all into a single pandas dataframe
-    train_dir = [ os.path.join(args.train, file) for file in os.listdir(args.train) ]
-    if len(train_dir) == 0:
+    # os.scandir entries carry their file type from the directory listing, so no extra stat call is made per file
+    def iter_input_files(root):
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False): # item in train folder may be a directory with files (directory can't be read by Pandas)
+                    with os.scandir(entry.path) as subentries:
+                        yield from (subentry.path for subentry in subentries if subentry.is_file())
+                else:
+                    yield entry.path
+    
+    input_files = list(iter_input_files(args.train))
+    if len(input_files) == 0:
         raise ValueError(('There are no files in {}.\n' +
                           'This usually indicates that the channel ({}) was incorrectly specified,\n' +
                           'the data specification in S3 was incorrectly specified or the role specified\n' +
                           'does not have permission to access the data.').format(args.train, "train"))
-        
-    input_files = list()
-    for item in train_dir:
-        if os.path.isdir(item): # item in train folder may be a directory with files (directory can't be read by Pandas)
-            subitems = os.listdir(item)
-            for file in subitems:
-                input_files.append(item + '/' + file) # add full path to filename
-        else:
-            input_files.append(item)
     print('Input files: ', input_files)
-    raw_data = [ pd.read_csv(file) for file in input_files ]
-    concat_data = pd.concat(raw_data)
+    # pyarrow's multi-threaded reader parses each file straight into Arrow memory, so the data only gets
+    # converted to a single pandas dataframe once, after all the files have been combined.
+    # The preprocessed data written by the transform job has no header row, so generate the column names
+    read_options = pacsv.ReadOptions(use_threads=True, block_size=8 << 20, autogenerate_column_names=True)
+    def read_table(file):
+        table = pacsv.read_csv(file, read_options=read_options)
+        # every column is numeric, so give them all the dtype used for training; this way
+        # files whose columns were inferred differently (e.g. int64 vs double) can still be combined
+        return table.cast(pa.schema([(name, pa.float64()) for name in table.column_names]))
+    
+    # pyarrow releases the GIL while parsing, so the files can be read concurrently from a thread pool
+    with ThreadPoolExecutor(max_workers=min(32, len(input_files))) as executor:
+        tables = list(executor.map(read_table, input_files))
+    # the common case is a single file, which doesn't need combining
+    table = tables[0] if len(tables) == 1 else pa.concat_tables(tables)
+    del tables
+    concat_data = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
         
     # separate features and target variable
-    X = concat_data[concat_data.columns[1:]]
-    y = concat_data[concat_data.columns[0]]
+    # Convert to a single float64 array up front (the dtype HistGradientBoostingRegressor works in) so sklearn
+    # doesn't make its own copy during fit. Features are stored column-major since the binning scans them column by column
+    arr = concat_data.to_numpy(dtype=np.float64, copy=False)
+    del concat_data
+    y = arr[:, 0]
+    X = np.asfortranarray(arr[:, 1:])
     
     hyperparameters = {
         "max_depth": args.max_depth,
         "verbose": 1,  # show all logs
         "min_samples_leaf": args.min_samples_leaf,
-        "min_samples_split": args.min_samples_split,
-        "n_estimators": args.n_estimators,
+        "max_iter": args.n_estimators, # number of boosting iterations, i.e. trees
+        "early_stopping": True,
     }
     
     print("Training the regressor")
-    model = RandomForestRegressor()
+    model = HistGradientBoostingRegressor()
     model.set_params(**hyperparameters)
-    model.fit(X, y)
+    # HistGradientBoostingRegressor parallelizes the fit with OpenMP threads that share the training data
+    # rather than with joblib workers, so the number of cores is controlled through the OpenMP thread pool.
+    # Negative values count back from the number of cores, the same way joblib resolves them
+    n_threads = max(joblib.cpu_count() + 1 + args.n_jobs, 1) if args.n_jobs < 0 else args.n_jobs
+    with threadpool_limits(limits=n_threads, user_api='openmp'):
+        model.fit(X, y)
     
-    joblib.dump(model, os.path.join(args.model_dir, "model.joblib"))
+    # saved uncompressed so model_fn can memory-map the tree arrays instead of copying them into every worker
+    joblib.dump(model, os.path.join(args.model_dir, "model.joblib"), compress=0)
 
 def model_fn(model_dir):
     """
     Deserialized and return fitted model
     Note that this should have the same name as the serialized model in the main method
     """
-    model = joblib.load(os.path.join(model_dir, "model.joblib"))
+    model = joblib.load(os.path.join(model_dir, "model.joblib"), mmap_mode='r')
     return model
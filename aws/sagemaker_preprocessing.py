@@ -1,20 +1,15 @@
-import argparse
 import joblib
 import os
-import json
-import sys
-from io import StringIO
-import pandas as pd
 import numpy as np
-from sklearn.pipeline import Pipeline
-from sklearn.compose import ColumnTransformer
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.preprocessing import OneHotEncoder
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from sagemaker_containers import _encoders as encoders
 from sagemaker_containers import _worker as worker
 
 # the following may be required in order to get the SKLearn container to deploy properly
 # see the following issue: https://github.com/aws/sagemaker-python-sdk/issues/648
+# import sys
 # module_path = os.path.abspath('/opt/ml/code')
 # if module_path not in sys.path:
 #     sys.path.append(module_path)
@@ -27,10 +22,34 @@ feature_columns_names = ['school', 'sex', 'age', 'address', 'famsize', 'Pstatus'
 
 label_column = 'G3'
 
+# a labelled request has every feature column followed by the label
+n_cols_labelled = len(feature_columns_names) + 1
+
 numeric_cols_to_keep = ['age', 'Medu', 'traveltime', 'studytime', 'failures', 'goout', 'Dalc', 'absences']
 nominal_cols_to_keep = ['address', 'Fjob', 'guardian', 'higher', 'internet', 'romantic']
 
+# only these columns are read from the training data, with their types given upfront so they don't have to be inferred
+columns_to_read = numeric_cols_to_keep + nominal_cols_to_keep + [label_column]
+column_types = {**{col: pa.float32() for col in numeric_cols_to_keep},
+                **{col: pa.dictionary(pa.int32(), pa.string()) for col in nominal_cols_to_keep},
+                label_column: pa.float32()}
+
+# The preprocessor is fitted on a plain array of the kept columns (numeric first, then nominal) and selects them
+# by position, so transforming a request doesn't go through pandas column lookups for every transformer
+cols_to_keep = numeric_cols_to_keep + nominal_cols_to_keep
+numeric_cols_idx = list(range(len(numeric_cols_to_keep)))
+nominal_cols_idx = list(range(len(numeric_cols_to_keep), len(cols_to_keep)))
+
 if __name__ == '__main__':
+    # The training dependencies are only imported here, so the inference container doesn't load them at startup
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+    from sklearn.pipeline import Pipeline
+    from sklearn.compose import ColumnTransformer
+    from sklearn.preprocessing import FunctionTransformer
+    from sklearn.preprocessing import MinMaxScaler
+    from sklearn.preprocessing import OneHotEncoder
+    
     parser = argparse.ArgumentParser()
     
     # Sagemaker specific arguments. Defaults are set in the environment variables.
@@ -47,22 +66,39 @@ if __name__ == '__main__':
                           'This usually indicates that the channel ({}) was incorrectly specified,\n' +
                           'the data specification in S3 was incorrectly specified or the role specified\n' +
                           'does not have permission to access the data.').format(args.train, "train"))
-    raw_data = [ pd.read_csv(
-        file, 
-        header=0, 
-        index_col=0) for file in input_files ]
-    concat_data = pd.concat(raw_data)
+    read_options = pacsv.ReadOptions(use_threads=True, block_size=8 << 20)
+    parse_options = pacsv.ParseOptions(delimiter=',')
+    convert_options = pacsv.ConvertOptions(include_columns=columns_to_read, column_types=column_types)
+    # pyarrow releases the GIL while parsing, so the files can be read concurrently from a thread pool
+    with ThreadPoolExecutor(max_workers=min(32, len(input_files))) as executor:
+        tables = list(executor.map(lambda file: pacsv.read_csv(
+            file, 
+            read_options=read_options, 
+            parse_options=parse_options, 
+            convert_options=convert_options), input_files))
+    # the common case is a single file, which doesn't need combining. The column types are fixed, so the tables share a schema
+    table = tables[0] if len(tables) == 1 else pa.concat_tables(tables)
+    del tables
+    concat_data = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
         
+    # Both transformers output float32 (half the size of the default float64) so the concatenated features stay float32.
+    # The numeric columns are cast first since MinMaxScaler keeps the dtype of its input
+    numeric_transformer = Pipeline([("cast", FunctionTransformer(np.asarray, kw_args={"dtype": np.float32})),
+                                    ("scale", MinMaxScaler())])
     preprocessor = ColumnTransformer(
-         transformers = [("numeric", MinMaxScaler(), numeric_cols_to_keep),
-                         ("nominal", OneHotEncoder(drop='if_binary', handle_unknown='error'), nominal_cols_to_keep)],
+         transformers = [("numeric", numeric_transformer, numeric_cols_idx),
+                         ("nominal", OneHotEncoder(drop='if_binary', handle_unknown='error', dtype=np.float32), nominal_cols_idx)],
          remainder = 'drop',
+         sparse_threshold = 0, # always return a single dense array
          n_jobs = -1
     )
     
-    preprocessor.fit(concat_data)
+    preprocessor.fit(concat_data[cols_to_keep].to_numpy())
+    # transforming a single request is far cheaper than starting parallel workers for it
+    preprocessor.set_params(n_jobs=None)
     
-    joblib.dump(preprocessor, os.path.join(args.model_dir, "model.joblib"))
+    joblib.dump(preprocessor, os.path.join(args.model_dir, "model.joblib"), compress=('zlib', 3)) # compress to shrink the artifact uploaded to S3
     
     
 def input_fn(input_data, content_type):
@@ -75,10 +111,16 @@ def input_fn(input_data, content_type):
     """
     if content_type == 'text/csv':
         # Read the raw input data as CSV
-        # We need to use StringIO because the input_data will be the actual csv data, not the filename
-        df = pd.read_csv(StringIO(input_data), index_col=0)
+        # We need to wrap it in a buffer because the input_data will be the actual csv data, not the filename.
+        # The known column types are passed in so pyarrow doesn't have to infer them for every request
+        buffer = pa.py_buffer(input_data.encode() if isinstance(input_data, str) else input_data)
+        table = pacsv.read_csv(
+            buffer, 
+            read_options=pacsv.ReadOptions(use_threads=False), 
+            convert_options=pacsv.ConvertOptions(column_types=column_types))
+        df = table.remove_column(0).to_pandas() # the first column is the row index, so drop it
         
-        if len(df.columns) == len(feature_columns_names) + 1:
+        if len(df.columns) == n_cols_labelled:
             # This is a labelled example, includes the G3 label
             df.columns = feature_columns_names + [label_column]
         elif len(df.columns) == len(feature_columns_names):
@@ -99,38 +141,93 @@ def output_fn(prediction, accept):
     container can read the response payload correctly.
     """
     if accept == "application/json":
-        instances = []
-        for row in prediction.tolist():
-            instances.append({"features": row})
+        # orjson serializes the numpy rows natively, so the prediction never gets converted to Python floats
+        prediction = np.ascontiguousarray(prediction)
+        json_output = {"instances": [{"features": row} for row in prediction]}
 
-        json_output = {"instances": instances}
-
-        return worker.Response(json.dumps(json_output), accept, mimetype=accept) # we use the Sagemaker container helper classes to return the proper types
-#         return json.dumps(json_output)
+        return worker.Response(orjson.dumps(json_output, option=orjson.OPT_SERIALIZE_NUMPY), accept, mimetype=accept) # we use the Sagemaker container helper classes to return the proper types
+#         return orjson.dumps(json_output, option=orjson.OPT_SERIALIZE_NUMPY)
     elif accept == 'text/csv':
         return worker.Response(encoders.encode(prediction, accept), accept, mimetype=accept) # we use the Sagemaker container helper classes to return the proper types
     else:
         raise RuntimeError("{} accept type is not supported by this script.".format(accept))
         
         
+class FusedPreprocessor:
+    """Fitted preprocessor with its MinMaxScaler and OneHotEncoder fused into a single numpy pass
+
+    The parameters learned by the ColumnTransformer are frozen once, when the model is loaded: the scaler's
+    affine transform, and for each nominal column its (sorted) categories along with the output column each
+    one is encoded to (-1 for a dropped category). transform() applies them directly to an array laid out
+    like cols_to_keep, skipping sklearn's per-call dispatch and validation. If a request contains a category
+    that wasn't seen during training it falls back to the ColumnTransformer, which raises the proper error.
+    """
+    
+    def __init__(self, preprocessor):
+        self.preprocessor = preprocessor
+        scaler = preprocessor.named_transformers_['numeric'].named_steps['scale']
+        encoder = preprocessor.named_transformers_['nominal']
+        self.scale = scaler.scale_
+        self.min = scaler.min_
+        self.categories = encoder.categories_
+        self.output_cols = []
+        offset = len(numeric_cols_to_keep)
+        drop_idxs = encoder.drop_idx_ if encoder.drop_idx_ is not None else [None] * len(encoder.categories_)
+        for categories, drop_idx in zip(encoder.categories_, drop_idxs):
+            cols = np.arange(offset, offset + len(categories))
+            if drop_idx is not None:
+                cols[drop_idx] = -1
+                cols[drop_idx + 1:] -= 1
+            self.output_cols.append(cols)
+            offset = cols.max() + 1
+        self.n_features_out = offset
+    
+    def transform(self, X):
+        features = self._fused_transform(X)
+        return self.preprocessor.transform(X) if features is None else features
+    
+    def _fused_transform(self, X):
+        n_numeric = len(numeric_cols_to_keep)
+        features = np.zeros((X.shape[0], self.n_features_out), dtype=np.float32)
+        features[:, :n_numeric] = X[:, :n_numeric].astype(np.float32) * self.scale + self.min
+        
+        rows = np.arange(X.shape[0])
+        for i, (categories, output_cols) in enumerate(zip(self.categories, self.output_cols)):
+            values = X[:, n_numeric + i]
+            try:
+                codes = np.minimum(np.searchsorted(categories, values), len(categories) - 1)
+            except TypeError: # missing values can't be compared with the categories
+                return None
+            if not np.all(categories[codes] == values):
+                return None
+            cols = output_cols[codes]
+            encoded = cols >= 0
+            features[rows[encoded], cols[encoded]] = 1
+        return features
+        
+        
 def predict_fn(input_data, model):
     """Preprocess input data
 
     We implement this because the default predict_fn uses .predict(), but our model is a preprocessor
     so we want to use .transform().
     """
-    features = model.transform(input_data)
+    features = model.transform(input_data[cols_to_keep].to_numpy())
     
     # if labels were passed in, we need to add them back to the dataset because ColumnTransformer will remove them
-    if label_column in input_data:
+    if input_data.shape[1] == n_cols_labelled:
         # Return the label (as the first column) and the set of features.
-        return np.insert(features, 0, input_data[label_column], axis=1)
+        # Write both into a preallocated array rather than np.insert, which shifts every feature column over by one
+        output = np.empty((features.shape[0], features.shape[1] + 1), dtype=features.dtype)
+        output[:, 0] = input_data[label_column].to_numpy()
+        output[:, 1:] = features
+        return output
     else:
         # Return only the set of features
         return features
     
 def model_fn(model_dir):
-    """Deserialize fitted model
+    """Deserialize fitted model and wrap it in a FusedPreprocessor
     """
     preprocessor = joblib.load(os.path.join(model_dir, "model.joblib"))
-    return preprocessor
+    return FusedPreprocessor(preprocessor)